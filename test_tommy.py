@@ -0,0 +1,31 @@
+import pandas as pd
+
+import tommy
+
+
+def test_validate_data_date_order(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+
+    dates = [20200301, 20200302, 20200305, 20200303, 20200304, 20200306, 20200306]
+    df_stringency = pd.DataFrame({
+        'CountryCode': 'AAA',
+        'CountryName': 'A',
+        'Date': dates,
+        'S7_International travel controls': 0,
+        'ConfirmedCases': range(len(dates)),
+        'ConfirmedDeaths': 0,
+        })
+    df_jhu = pd.DataFrame({
+        'Province/State': [None],
+        'Country/Region': ['A'],
+        'Lat': [0],
+        'Long': [0],
+        '3/1/20': [1],
+        })
+
+    df_stringency, _, _, _ = tommy.validate_data(
+        df_stringency, df_jhu, df_jhu.copy(), df_jhu.copy(), {'A': 'AAA'})
+
+    # The dates behind the jump to 0305 and the repeated 0306 are quarantined.
+    assert list(df_stringency['Date']) == [20200301, 20200302, 20200305, 20200306]
@@ -4,14 +4,16 @@
 # built-in
 import itertools
 import operator
+import os
+import sqlite3
 import sys
 from datetime import datetime
 from datetime import timedelta
 import json
+from multiprocessing import Pool
 
 # not built-in
 import pandas as pd
-from scipy.optimize import curve_fit
 import numpy as np
 
 import pycountry
@@ -20,6 +22,16 @@ import iso3166
 
 def main():
 
+    # Query a stored score without rerunning anything, e.g.
+    # tommy.py query DEU 20200501 20200601
+    # for the score of DEU on 1 May 2020 as computed on 1 June 2020.
+    if sys.argv[1:2] == ['query']:
+        CountryCode, Date, run = sys.argv[2:5]
+        conn = open_store()
+        print(query_score(conn, CountryCode, int(Date), int(run)))
+        conn.close()
+        return
+
     url_confirmed = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv'
     url_deaths = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_global.csv'
     url_recovered = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_recovered_global.csv'
@@ -59,10 +71,33 @@ def main():
     df_stringency = df_stringency[
         df_stringency['Date'] <= max(intDateToday - 1, intDateCommon)]
 
+    d_name2alpha = prepare_country_dict(df_stringency)
+
+    print('validating input data')
+    df_stringency, df_confirmed, df_deaths, df_recovered = validate_data(
+        df_stringency,
+        df_confirmed,
+        df_deaths,
+        df_recovered,
+        d_name2alpha,
+        )
+
     print('calculating iERPScoreB')
     calculate_iERPScoreB(df_stringency)
 
-    d_name2alpha = prepare_country_dict(df_stringency)
+    if 'backtest' in sys.argv[1:]:
+        print('backtesting forecasts')
+        backtest(df_stringency)
+        print('\nall done - happy days')
+        return
+
+    # Runs are identified by the date they were made on.
+    run = intDateToday
+    conn = open_store()
+
+    print('storing history')
+    store_history(conn, run, df_stringency)
+
     d_alpha2name = {}
     for country in df_confirmed['Country/Region'].unique():
         # Skip cruise line ships.
@@ -70,13 +105,6 @@ def main():
             continue
         d_alpha2name[d_name2alpha[country]] = country
 
-    # Check completeness and correctness of country dictionary.
-    set1 = set(df_confirmed['Country/Region'].values)
-    set2 = set(d_name2alpha.keys())
-    set3 = set(['MS Zaandam', 'Diamond Princess'])  # Cruise ships
-    _ = set1 - set2 - set3
-    assert len(_) == 0, _
-
     df_merged = merge_data_frames(
         df_confirmed, df_deaths, df_recovered)
 
@@ -87,11 +115,16 @@ def main():
         d_alpha2name,
         )
 
+    print('forecasting cases and deaths')
+    forecasts = forecast_across_countries(df_stringency)
+
     print('creating json file across countries')
 
     # Pregenerate unique country codes
     uniqueCC = df_stringency['CountryCode'].unique()
 
+    payloads = {}
+
     for country in df_confirmed['Country/Region'].unique():
 
         # Skip cruise line ships.
@@ -103,19 +136,20 @@ def main():
             print ('Not found in Oxford', country, alpha3)
             continue
 
-        do_json_per_country(
+        payloads[alpha3] = do_json_per_country(
             country,
             alpha3,
             df_stringency[df_stringency['CountryCode'] == alpha3],
+            forecasts[alpha3],
+            query_history(conn, alpha3, run),
             )
-        
-        bool_figure = False
-        if bool_figure is True:
-            s = df_stringency[df_stringency['CountryCode'] == alpha3]['iERPScoreB']
-            ax = s.plot.line()
-            fig = ax.get_figure()
-            fig.savefig('{}.png'.format(alpha3))
-            fig.clf()
+
+    print('storing forecasts')
+    store_forecasts(conn, run, payloads)
+    conn.close()
+
+    print('rendering charts')
+    render_charts(payloads)
 
     print('\nall done - happy days')
 
@@ -184,83 +218,369 @@ def logistic(x, a, b, c):
     return y
 
 
-def predict_logistic(values, dates):
+def gompertz(x, a, b, c):
 
-    dateLatest = datetime.strptime(str(
-        dates.tail(1).iat[0]), '%Y%m%d')
-    valueLatest = values.tail(1).iat[0]
-    yield valueLatest, dateLatest.strftime('%Y-%m-%d')
+    # a is maximum
+    # b is growth rate
+    # c is inflection point
 
-    # Guess seeding values.
-    guessMaximum = values.tail(1).iat[0] * 2
-    guessSteepness = 0.25
-    guessMidpoint = len(values)
-    p0 = [guessMaximum, guessSteepness, guessMidpoint]
+    y = a * np.exp(-np.exp(-b * (x - c)))
 
-    try:
-        popt, pcov = curve_fit(
-            logistic,
-            range(len(values)),
-            values,
-            p0=p0,
+    return y
+
+
+def damped_exponential(x, a, b, c):
+
+    # a is plateau
+    # b is distance below the plateau at x = 0
+    # c is decay rate of the daily increments
+
+    y = a - b * np.exp(-c * x)
+
+    return y
+
+
+def linear(x, a, b):
+
+    # a is intercept at x = 0
+    # b is slope
+
+    y = a + b * x
+
+    return y
+
+
+def logistic_jacobian(x, a, b, c):
+
+    e = np.exp(-b * (x - c))
+
+    return np.stack((
+        1 / (1 + e),
+        a * (x - c) * e / (1 + e) ** 2,
+        -a * b * e / (1 + e) ** 2,
+        ), axis=-1)
+
+
+def gompertz_jacobian(x, a, b, c):
+
+    e = np.exp(-b * (x - c))
+    y = np.exp(-e)
+
+    return np.stack((
+        y,
+        a * y * e * (x - c),
+        -a * y * e * b,
+        ), axis=-1)
+
+
+def damped_exponential_jacobian(x, a, b, c):
+
+    e = np.exp(-c * x)
+
+    return np.stack((
+        np.ones_like(x * a),
+        -e,
+        b * x * e,
+        ), axis=-1)
+
+
+def linear_jacobian(x, a, b):
+
+    return np.stack((
+        np.ones_like(x * a),
+        x * np.ones_like(b),
+        ), axis=-1)
+
+
+# Candidate growth models for the case/death forecasts.
+# name: (function, jacobian, window of most recent days to fit or None for all days,
+#        saturating, initial guess for a series scaled to its latest value being 1)
+# x is measured in days relative to the latest day of each series.
+FORECAST_MODELS = {
+    'logistic': (logistic, logistic_jacobian, None, True, (2, 0.25, 0)),
+    'gompertz': (gompertz, gompertz_jacobian, None, True, (2, 0.1, 0)),
+    'dampedExponential': (damped_exponential, damped_exponential_jacobian, 28, True, (1.5, 0.5, 0.1)),
+    'linear': (linear, linear_jacobian, 14, False, (1, 0.01)),
+    }
+
+
+def fit_batched(func, jacobian, x, values, mask, p0, iterations=100):
+
+    # Levenberg-Marquardt fit of one model to many series at once.
+    # x, values and mask have shape (series, days); only days where mask is True are fitted.
+    # p0 has shape (series, parameters).
+    # Returns the fitted parameters, their covariance and the residual variance per series.
+
+    p = np.array(p0, dtype=float)
+    nSeries, nParams = p.shape
+    eye = np.eye(nParams)
+
+    def residuals(p, rows):
+        r = np.where(mask[rows], values[rows] - func(x[rows], *np.split(p, nParams, axis=1)), 0)
+        cost = (r ** 2).sum(axis=1)
+        cost[~np.isfinite(cost)] = np.inf
+        return np.nan_to_num(r), cost
+
+    def jacobian_masked(p, rows):
+        J = jacobian(x[rows], *np.split(p, nParams, axis=1))
+        return np.nan_to_num(np.where(mask[rows][..., None], J, 0), posinf=0, neginf=0)
+
+    with np.errstate(all='ignore'):
+
+        r, cost = residuals(p, slice(None))
+        damping = np.full(nSeries, 1e-3)
+        active = np.isfinite(cost)
+
+        # Only series that have not converged yet take part in each iteration,
+        # so well started (e.g. warm started) series stop costing anything early.
+        for _ in range(iterations):
+            rows = np.flatnonzero(active)
+            if len(rows) == 0:
+                break
+
+            J = jacobian_masked(p[rows], rows)
+            Jt = J.transpose(0, 2, 1)
+            JtJ = Jt @ J
+            Jtr = (Jt @ r[rows][..., None])[..., 0]
+            A = JtJ + damping[rows, None, None] * JtJ * eye + 1e-12 * eye
+            try:
+                step = np.linalg.solve(A, Jtr[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                step = np.einsum('npq,nq->np', np.linalg.pinv(A), Jtr)
+
+            pNew = p[rows] + step
+            rNew, costNew = residuals(pNew, rows)
+
+            better = costNew < cost[rows]
+            converged = cost[rows] - costNew <= 1e-10 * cost[rows]
+            p[rows[better]] = pNew[better]
+            r[rows[better]] = rNew[better]
+            cost[rows[better]] = costNew[better]
+            damping[rows] = np.where(better, damping[rows] / 10, damping[rows] * 10)
+            active[rows] = ~(better & converged) & (damping[rows] < 1e10)
+
+        J = jacobian_masked(p, slice(None))
+        JtJ = J.transpose(0, 2, 1) @ J
+        dof = np.maximum(mask.sum(axis=1) - nParams, 1)
+        s2 = cost / dof
+        pcov = np.linalg.pinv(JtJ) * s2[:, None, None]
+
+    return p, pcov, s2
+
+
+def increment_covariance(func, jacobian, x, values, mask, p):
+
+    # Parameter covariance and residual variance of a fit, estimated from the daily increments.
+    # The residuals of cumulative counts are strongly autocorrelated, so treating them as
+    # independent (as fit_batched does) makes both far too small.
+    # Returns pcov of shape (series, parameters, parameters) and s2 of shape (series,),
+    # s2 being the variance of one day's increment.
+
+    nParams = p.shape[1]
+    split = np.split(p, nParams, axis=1)
+
+    with np.errstate(all='ignore'):
+        residual = values - func(x, *split)
+        J = jacobian(x, *split)
+        maskIncrement = mask[:, 1:] & mask[:, :-1]
+        r = np.nan_to_num(np.where(maskIncrement, residual[:, 1:] - residual[:, :-1], 0))
+        J = np.nan_to_num(
+            np.where(maskIncrement[..., None], J[:, 1:] - J[:, :-1], 0), posinf=0, neginf=0)
+        dof = np.maximum(maskIncrement.sum(axis=1) - nParams, 1)
+        s2 = (r ** 2).sum(axis=1) / dof
+        pcov = np.linalg.pinv(J.transpose(0, 2, 1) @ J) * s2[:, None, None]
+
+    return pcov, s2
+
+
+def band_factor(z, mask, horizon, days, quantile=0.95):
+
+    # Band width in standard deviations for the latest day and the following days:
+    # per holdout horizon the quantile of the standardised holdout errors z across all series,
+    # extrapolated linearly beyond the holdout days.
+    # It is never narrower than a normal 95% band.
+
+    holdout = int(horizon[mask].max()) if mask.any() else 0
+    factors = np.full(holdout, np.nan)
+    for h in range(1, holdout + 1):
+        _ = z[mask & (horizon == h) & np.isfinite(z)]
+        if len(_) > 0:
+            factors[h - 1] = np.quantile(_, quantile)
+
+    known = np.isfinite(factors)
+    factor = np.full(days + 1, 1.96)
+    if known.sum() >= 2:
+        slope, intercept = np.polyfit(np.flatnonzero(known) + 1, factors[known], 1)
+        factor = intercept + max(slope, 0) * np.arange(days + 1)
+    n = min(holdout, days)
+    factor[1:n + 1] = np.where(known[:n], factors[:n], factor[1:n + 1])
+
+    return np.maximum(factor, 1.96)
+
+
+def forecast_batched(values, lastIdx, days=21, holdout=7, p0s=None):
+
+    # Fit every model in FORECAST_MODELS to all series at once,
+    # select a model per series by its error on the most recent holdout days,
+    # and return forecasts with prediction bands for the latest day and the following days.
+    # The bands are calibrated so that they would have covered 95% of the holdout errors
+    # across all series; beyond the holdout days the calibration is extrapolated.
+    # values has shape (series, days) with NaN for missing days.
+    # p0s optionally holds parameters from a previous call to warm start the fits.
+
+    nSeries, nDays = values.shape
+    rows = np.arange(nSeries)
+
+    latest = values[rows, lastIdx]
+    scale = np.maximum(latest, 1)
+    y = np.nan_to_num(values / scale[:, None])
+    x = (np.arange(nDays)[None, :] - lastIdx[:, None]).astype(float)
+    valid = np.isfinite(values) & (x <= 0)
+    xFuture = np.tile(np.arange(days + 1, dtype=float), (nSeries, 1))
+
+    names = list(FORECAST_MODELS.keys())
+    errors = np.full((len(names), nSeries), np.inf)
+    means = np.zeros((len(names), nSeries, days + 1))
+    bands = np.zeros((len(names), nSeries, days + 1))
+    params = {}
+
+    for i, name in enumerate(names):
+        func, jacobian, window, saturating, guess = FORECAST_MODELS[name]
+        nParams = len(guess)
+        p0 = np.tile(np.array(guess, dtype=float), (nSeries, 1))
+        if p0s is not None and name in p0s:
+            p0 = np.where(np.isfinite(p0s[name]), p0s[name], p0)
+
+        # Fit on all but the most recent days, then score the fit on those days.
+        maskTrain = valid & (x <= -holdout)
+        if window is not None:
+            maskTrain &= x > -window - holdout
+        pTrain, _, _ = fit_batched(func, jacobian, x, y, maskTrain, p0)
+        splitTrain = np.split(pTrain, nParams, axis=1)
+
+        maskTest = valid & (x > -holdout)
+        with np.errstate(all='ignore'):
+            residual = func(x, *splitTrain) - y
+            error = np.where(maskTest, residual, 0)
+            error = np.sqrt((error ** 2).sum(axis=1) / np.maximum(maskTest.sum(axis=1), 1))
+        okTrain = np.isfinite(error) & (maskTrain.sum(axis=1) > nParams)
+
+        # Refit on all days, warm started from the holdout fit.
+        mask = valid if window is None else valid & (x > -window)
+        p, _, _ = fit_batched(
+            func, jacobian, x, y, mask,
+            np.where(np.isfinite(pTrain), pTrain, p0),
             )
+        params[name] = p
+
+        with np.errstate(all='ignore'):
+            # Standardise the holdout errors by the spread the training fit expected for them,
+            # and find per horizon the factor that covers 95% of them.
+            pcovTrain, s2Train = increment_covariance(func, jacobian, x, y, maskTrain, pTrain)
+            gradient = jacobian(x, *splitTrain)
+            variance = np.einsum('ntp,npq,ntq->nt', gradient, pcovTrain, gradient) + (x + holdout) * s2Train[:, None]
+            z = np.abs(residual) / np.sqrt(variance)
+            factor = band_factor(z, maskTest & okTrain[:, None], x + holdout, days)
+
+            # Prediction band from the spread expected for the full fit, times that factor.
+            split = np.split(p, nParams, axis=1)
+            mean = func(xFuture, *split)
+            pcovFull, s2Full = increment_covariance(func, jacobian, x, y, mask, p)
+            gradient = jacobian(xFuture, *split)
+            variance = np.einsum('nhp,npq,nhq->nh', gradient, pcovFull, gradient) + xFuture * s2Full[:, None]
+            band = factor[None, :] * np.sqrt(np.maximum(variance, 0))
+
+        ok = okTrain & (mask.sum(axis=1) > nParams)
+        ok &= np.isfinite(mean).all(axis=1) & np.isfinite(band).all(axis=1)
+        # Revert to another model, if the fitted maximum is below the latest value.
+        if saturating:
+            ok &= (pTrain[:, 0] >= 1) & (p[:, 0] >= 1)
+
+        errors[i] = np.where(ok, error, np.inf)
+        means[i] = np.nan_to_num(mean)
+        bands[i] = np.nan_to_num(band)
+
+    best = np.argmin(errors, axis=0)
+    best[~np.isfinite(errors.min(axis=0))] = names.index('linear')
+
+    # Scale back and keep the cumulative counts from decreasing.
+    forecast = means[best, rows] * scale[:, None]
+    lower = (means[best, rows] - bands[best, rows]) * scale[:, None]
+    upper = (means[best, rows] + bands[best, rows]) * scale[:, None]
+    forecast[:, 0] = lower[:, 0] = upper[:, 0] = latest
+    forecast = np.maximum.accumulate(np.maximum(forecast, latest[:, None]), axis=1)
+    lower = np.maximum.accumulate(np.maximum(lower, latest[:, None]), axis=1)
+    upper = np.maximum(upper, forecast)
+
+    return {
+        'model': [names[i] for i in best],
+        'forecast': forecast,
+        'lower': lower,
+        'upper': upper,
+        'params': params,
+        }
 
-        if type(pcov) != float:
-            perr = np.sqrt(np.diag(pcov))
-            fitMaximum, fitSteepness, fitMidpoint = popt
-        else:
-            fitMaximum = 0
-    except RuntimeError:
-        fitMaximum = 0
-
-    # Revert to linear fit, if fit to logistic function fails.
-    if fitMaximum < valueLatest:
-        for valuePredicted, dateISO in predict_linear(values, dates):
-            yield valuePredicted, dateISO
-        return
 
-    # Get fitted values 3 weeks into the future.
-    for days in range(1, 21 + 1):
-        dateISO = operator.add(
-            dateLatest,
-            timedelta(days=days),
-            ).strftime('%Y-%m-%d')
-        valuePredicted = logistic(len(values) + days, *popt)
-        yield valuePredicted, dateISO
+def rebase_params(params, days, ratio):
 
-    return
+    # Express parameters fitted by forecast_batched in the frame of a cutoff that is
+    # `days` later, where x is measured from the new latest day (x - days)
+    # and y is scaled by the new latest value (y * ratio, ratio = old scale / new scale).
+    # days and ratio have shape (series,).
 
+    days = np.asarray(days, dtype=float)
+    ratio = np.asarray(ratio, dtype=float)
+    rebased = {}
 
-def predict_linear(cases, dates):
-    s = pd.Series(cases)
+    for name, p in params.items():
+        p = p.copy()
+        if name in ('logistic', 'gompertz'):
+            p[:, 0] *= ratio
+            p[:, 2] -= days
+        elif name == 'dampedExponential':
+            p[:, 0] *= ratio
+            with np.errstate(over='ignore'):
+                p[:, 1] *= ratio * np.exp(-p[:, 2] * days)
+        elif name == 'linear':
+            p[:, 0] = ratio * (p[:, 0] + p[:, 1] * days)
+            p[:, 1] *= ratio
+        rebased[name] = p
 
-    change = s.pct_change(periods=3).tail(1).iat[0]
-    lastValue = cases.tail(1).iat[0]
-    lastDate = dates.tail(1).iat[0]
-    reduction = change / 100 * 3
+    return rebased
 
-    predictions = []
 
-    if (lastValue < 30):
-        for x in range(0, 21):
-            dateISO = operator.add(
-                datetime.strptime(str(lastDate), '%Y%m%d'),
-                timedelta(days=x),
-                ).strftime('%Y-%m-%d')
-            predictions.append([lastValue, dateISO])
+def forecast_across_countries(df_stringency, columns=('ConfirmedCases', 'ConfirmedDeaths'), days=21):
 
-    else:
-        for x in range(0, 21):
-            dateISO = operator.add(
-                datetime.strptime(str(lastDate), '%Y%m%d'),
-                timedelta(days=x),
-                ).strftime('%Y-%m-%d')
-            predictions.append([lastValue, dateISO])
+    # Forecast each column for all countries in one batch.
+    # Returns {CountryCode: {column: (model, [(value, lower, upper, dateISO), ...])}}
+    # with the first point being the latest actual value.
 
-            change = change - reduction
-            lastValue = lastValue + (lastValue * change)
+    d = {}
 
-    return predictions
+    for column in columns:
+        df = df_stringency.pivot(index='CountryCode', columns='Date', values=column)
+        values = df.values.astype(float)
+        lastIdx = values.shape[1] - 1 - np.argmax(np.isfinite(values[:, ::-1]), axis=1)
+
+        result = forecast_batched(values, lastIdx, days=days)
+
+        for i, CountryCode in enumerate(df.index):
+            dateLatest = datetime.strptime(str(df.columns[lastIdx[i]]), '%Y%m%d')
+            points = []
+            for day in range(days + 1):
+                dateISO = operator.add(
+                    dateLatest,
+                    timedelta(days=day),
+                    ).strftime('%Y-%m-%d')
+                points.append((
+                    result['forecast'][i, day],
+                    result['lower'][i, day],
+                    result['upper'][i, day],
+                    dateISO,
+                    ))
+            d.setdefault(CountryCode, {})[column] = (result['model'][i], points)
+
+    return d
 
 
 def append_predictions(dateLast, value, deltaDays1, deltaDays2):
@@ -285,17 +605,34 @@ def predict_scores(scores, dates):
         dates.tail(1).iat[0]), '%Y%m%d')
     valueLast = scores.tail(1).iat[0]
 
-    predictions = [[valueLast, dateLast.strftime('%Y-%m-%d')]]
-
     scoresConsecutive, daysConsecutive = zip(*(
         (k, len(list(g))) for k, g in itertools.groupby(scores)))
 
     assert scoresConsecutive[-1] == valueLast
 
-    val1 = scoresConsecutive[-1]
-    val2 = scoresConsecutive[-2]
-    len1 = daysConsecutive[-1]
-    len2 = daysConsecutive[-2]
+    if len(scoresConsecutive) == 1:
+        return predict_scores_from_runs(
+            dateLast, scoresConsecutive[-1], None, daysConsecutive[-1], None)
+
+    return predict_scores_from_runs(
+        dateLast,
+        scoresConsecutive[-1],
+        scoresConsecutive[-2],
+        daysConsecutive[-1],
+        daysConsecutive[-2],
+        )
+
+
+def predict_scores_from_runs(dateLast, val1, val2, len1, len2):
+
+    # val1 and len1 are the value and length of the latest run of identical scores,
+    # val2 and len2 those of the run before it, or None if there is none.
+
+    predictions = [[val1, dateLast.strftime('%Y-%m-%d')]]
+
+    # The score has never changed, so there are no runs to extrapolate from.
+    if val2 is None:
+        return predictions + append_predictions(dateLast, val1, 1, 21)
 
     # 1. if today's business score is less than 3 ->
     # today+1 - today+21 = will be equal current business score
@@ -326,7 +663,6 @@ def predict_scores(scores, dates):
         predictions += append_predictions(dateLast, val1, 1, 14 - len1)
         # if "val2" is less than 7 -> today+(14-"len1") - today+21 = val2
         if val2 < 7:
-            assert len1 < 14  # Make Jozef aware it can throw an assertion error!
             predictions += append_predictions(dateLast, val2, 14 - len1 + 1, 21)
         # if "val2" is more or equal 7 -> today+(14-"len1") - today+21 = (val2 - 1)
         else:
@@ -353,10 +689,8 @@ def predict_scores(scores, dates):
 
     # This should not happen.
     else:
-        print(list(scores))
-        print(val1, val2)
-        print(len1, len2)
-        exit()
+        raise ValueError('no rule for val1={} val2={} len1={} len2={}'.format(
+            val1, val2, len1, len2))
 
     # Check that a prediction is not made for the same date twice.
     assert len(predictions) == len(set(list(zip(*predictions))[1])), predictions
@@ -366,7 +700,163 @@ def predict_scores(scores, dates):
     return predictions
 
 
-def do_json_per_country(country, alpha3, df_stringency):
+def backtest(df_stringency, horizons=(7, 14, 21), minDays=28, processes=None, warmStart=False):
+
+    # Replay history: for every past cutoff date and every country,
+    # forecast from the data up to that date and compare with what actually happened.
+    # Writes one row per country, cutoff, series and horizon to backtest.csv
+    # and the mean errors per series, model and horizon to backtest-summary.json.
+
+    arrays = {}
+    for column in ('iERPScoreB', 'ConfirmedCases', 'ConfirmedDeaths'):
+        df = df_stringency.pivot(index='CountryCode', columns='Date', values=column)
+        arrays[column] = df.values.astype(float)
+    countryCodes = list(df.index)
+    dates = list(df.columns)
+
+    # Runs of identical scores for every prefix at once, so each cutoff
+    # does not have to regroup the whole history as predict_scores does.
+    # Missing days (NaN) are skipped, i.e. neither counted nor allowed to split a run.
+    scores = arrays['iERPScoreB']
+    valid = np.isfinite(scores)
+    idx = np.arange(len(dates))
+    count = np.cumsum(valid, axis=1)  # valid days up to and including each day
+    lastValid = np.maximum.accumulate(np.where(valid, idx, -1), axis=1)
+    previousIdx = np.roll(lastValid, 1, axis=1)  # latest valid day before each day
+    previousIdx[:, 0] = -1
+    previous = np.where(
+        previousIdx >= 0,
+        np.take_along_axis(scores, np.maximum(previousIdx, 0), axis=1),
+        np.nan)
+    change = valid & (previous != scores)
+    start = np.maximum.accumulate(np.where(change, idx, 0), axis=1)
+    before = np.take_along_axis(previousIdx, start, axis=1)  # latest valid day of the run before
+    startBefore = np.take_along_axis(start, np.maximum(before, 0), axis=1)
+    runs = np.stack((
+        scores,  # val1
+        np.where(before >= 0, np.take_along_axis(scores, np.maximum(before, 0), axis=1), np.nan),  # val2
+        count - np.take_along_axis(count, start, axis=1) + 1,  # len1
+        np.take_along_axis(count, start, axis=1) - np.take_along_axis(count, startBefore, axis=1),  # len2
+        ), axis=-1)
+
+    # Each worker walks a block of consecutive cutoffs,
+    # so with warmStart every fit can start from the previous cutoff's fit.
+    # This is off by default: warm started fits can settle in other local optima
+    # than the cold started fits of the published forecasts, so the backtest
+    # would no longer measure the forecasts as published.
+    if processes is None:
+        processes = os.cpu_count()
+    cutoffs = np.arange(minDays - 1, len(dates) - min(horizons))
+    chunks = [_ for _ in np.array_split(cutoffs, 2 * processes) if len(_) > 0]
+
+    with Pool(processes) as pool:
+        results = pool.map(backtest_chunk, [
+            (chunk, dates, countryCodes, arrays, runs, horizons, warmStart) for chunk in chunks])
+
+    df = pd.DataFrame(
+        list(itertools.chain.from_iterable(results)),
+        columns=[
+            'CountryCode', 'cutoff', 'series', 'horizon', 'model',
+            'predicted', 'lower', 'upper', 'actual'],
+        )
+    df['absoluteError'] = (df['predicted'] - df['actual']).abs()
+    df['absolutePercentageError'] = 100 * df['absoluteError'] / df['actual'].where(df['actual'] != 0)
+    df['covered'] = ((df['lower'] <= df['actual']) & (df['actual'] <= df['upper'])).where(
+        df['lower'].notnull())
+    df.to_csv('backtest.csv', index=False)
+
+    d = {}
+    for (series, model, horizon), group in df.groupby(['series', 'model', 'horizon']):
+        d.setdefault(series, {}).setdefault(model, {})[str(horizon)] = {
+            'n': len(group),
+            'meanAbsoluteError': group['absoluteError'].mean(),
+            'meanAbsolutePercentageError': group['absolutePercentageError'].mean(),
+            'coverage': group['covered'].astype(float).mean(),
+            }
+        for k, v in d[series][model][str(horizon)].items():
+            if k != 'n':
+                d[series][model][str(horizon)][k] = None if pd.isnull(v) else round(float(v), 3)
+
+    with open('backtest-summary.json', 'w') as f:
+        json.dump(d, f, indent=4)
+
+    return df
+
+
+def backtest_chunk(args):
+
+    # Backtest a block of consecutive cutoffs (indices into dates).
+    # Runs in a worker process, hence the single argument.
+
+    cutoffs, dates, countryCodes, arrays, runs, horizons, warmStart = args
+
+    rows = []
+    nSeries, nDays = arrays['iERPScoreB'].shape
+
+    # Latest fitted parameters per column and model, and the cutoff and scale they were fitted at.
+    params = {}
+    fittedAt = {}
+    scales = {}
+
+    for t in cutoffs:
+        dateCutoff = datetime.strptime(str(dates[t]), '%Y%m%d')
+        dateISO = dateCutoff.strftime('%Y-%m-%d')
+
+        actual = arrays['iERPScoreB']
+        for i in np.flatnonzero(np.isfinite(runs[:, t, 0])):
+            val1, val2, len1, len2 = runs[i, t]
+            if np.isnan(val2):
+                # The score has never changed up to this cutoff.
+                val2 = len2 = None
+            else:
+                len2 = int(len2)
+            predictions = predict_scores_from_runs(
+                dateCutoff, val1, val2, int(len1), len2)
+            for h in horizons:
+                if t + h < nDays and np.isfinite(actual[i, t + h]):
+                    rows.append((
+                        countryCodes[i], dateISO, 'iERPScoreB', h, 'rules',
+                        predictions[h][0], np.nan, np.nan, actual[i, t + h]))
+
+        for column in ('ConfirmedCases', 'ConfirmedDeaths'):
+            actual = arrays[column]
+            present = np.flatnonzero(np.isfinite(actual[:, t]))
+            scale = np.maximum(actual[present, t], 1)
+            if warmStart and column in params:
+                # Warm start from the previous fits, shifted and rescaled to this cutoff.
+                p0s = rebase_params(
+                    {name: p[present] for name, p in params[column].items()},
+                    t - fittedAt[column][present],
+                    scales[column][present] / scale,
+                    )
+            else:
+                params.setdefault(column, {})
+                fittedAt.setdefault(column, np.full(nSeries, np.nan))
+                scales.setdefault(column, np.full(nSeries, np.nan))
+                p0s = None
+            result = forecast_batched(
+                actual[present, :t + 1],
+                np.full(len(present), t),
+                days=max(horizons),
+                p0s=p0s,
+                )
+            for name, p in result['params'].items():
+                params[column].setdefault(
+                    name, np.full((nSeries, p.shape[1]), np.nan))[present] = p
+            fittedAt[column][present] = t
+            scales[column][present] = scale
+            for j, i in enumerate(present):
+                for h in horizons:
+                    if t + h < nDays and np.isfinite(actual[i, t + h]):
+                        rows.append((
+                            countryCodes[i], dateISO, column, h, result['model'][j],
+                            result['forecast'][j, h], result['lower'][j, h],
+                            result['upper'][j, h], actual[i, t + h]))
+
+    return rows
+
+
+def do_json_per_country(country, alpha3, df_stringency, forecasts, history):
 
     # https://github.com/iERP-ai/businesswithcovid-generator/issues/1
 
@@ -405,19 +895,17 @@ def do_json_per_country(country, alpha3, df_stringency):
             d['scores']['iERPScoreBDays{}'.format(i)] = round(scorePredicted, 3)
 
     for k1, k2 in (('ConfirmedCases', 'cases'), ('ConfirmedDeaths', 'deaths')):
-        for valuePredicted, dateISO in predict_logistic(
-            df_stringency[k1],
-            df_stringency['Date'],
-            ):
-            d['graphs'][k2]['forecast'].append(
-                {'d': dateISO, k2: int(valuePredicted)})
-
-    for Date, iERPScoreB, cases, deaths in zip(
-        df_stringency['Date'],
-        df_stringency['iERPScoreB'],
-        df_stringency['ConfirmedCases'],
-        df_stringency['ConfirmedDeaths'],
-        ):
+        model, points = forecasts[k1]
+        d['graphs'][k2]['model'] = model
+        for valuePredicted, valueLower, valueUpper, dateISO in points:
+            d['graphs'][k2]['forecast'].append({
+                'd': dateISO,
+                k2: int(valuePredicted),
+                k2 + 'Lower': int(valueLower),
+                k2 + 'Upper': int(valueUpper),
+                })
+
+    for Date, iERPScoreB, cases, deaths in history:
         dateISO = datetime.strptime(str(Date), '%Y%m%d').strftime('%Y-%m-%d')
         d['graphs']['iERPScoreB']['history'].append(
             {'d': dateISO, 'iERPScoreB': round(iERPScoreB, 3)})
@@ -426,12 +914,159 @@ def do_json_per_country(country, alpha3, df_stringency):
         d['graphs']['deaths']['history'].append(
             {'d': dateISO, 'deaths': deaths})
 
-    with open('country-data-{}.json'.format(alpha3), 'w') as f:
+    # Version the payload and write a patch against the previously published version,
+    # so clients with a cached copy only need to fetch the patch.
+    path = 'country-data-{}.json'.format(alpha3)
+    try:
+        with open(path) as f:
+            dPrevious = json.load(f)
+    except (IOError, ValueError):
+        dPrevious = None
+
+    # Compare as published, i.e. after a round trip through json.
+    d = json.loads(json.dumps(d))
+    if dPrevious is None:
+        d['version'] = 1
+    else:
+        d['version'] = dPrevious.get('version', 0)
+        if d != dPrevious:
+            d['version'] += 1
+            with open('country-data-{}-delta.json'.format(alpha3), 'w') as f:
+                json.dump(delta_payload(dPrevious, d), f, separators=(',', ':'))
+
+    with open(path, 'w') as f:
         json.dump(d, f, indent=4)
 
+    return d
+
+
+def delta_payload(dOld, dNew):
+
+    # Patch that turns dOld into dNew.
+    # History entries are upserted by their date 'd' and dates in historyRemoved are deleted;
+    # everything else is replaced, if it changed.
+    # Clients whose cached version is not baseVersion must fetch the full payload.
+
+    delta = {
+        'baseVersion': dOld.get('version', 0),
+        'version': dNew['version'],
+        'graphs': {},
+        }
+
+    for key in ('limitations', 'scores'):
+        if dNew[key] != dOld.get(key):
+            delta[key] = dNew[key]
+
+    for series, graph in dNew['graphs'].items():
+        graphOld = dOld.get('graphs', {}).get(series, {})
+        historyOld = {_['d']: _ for _ in graphOld.get('history', [])}
+        patch = {'history': [_ for _ in graph['history'] if historyOld.get(_['d']) != _]}
+        removed = set(historyOld) - set(_['d'] for _ in graph['history'])
+        if removed:
+            patch['historyRemoved'] = sorted(removed)
+        for key, value in graph.items():
+            if key != 'history' and value != graphOld.get(key):
+                patch[key] = value
+        delta['graphs'][series] = patch
+
+    return delta
+
+
+def render_charts(payloads, processes=None):
+
+    # Render score, case and death charts for every country whose payload
+    # changed since the charts were last rendered, spread over a process pool.
+    # charts.json records the payload version each country's charts were rendered from.
+
+    try:
+        with open('charts.json') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+
+    todo = [
+        (alpha3, d) for alpha3, d in payloads.items()
+        if manifest.get(alpha3) != d['version']
+        or not os.path.exists('chart-{}-iERPScoreB.svg'.format(alpha3))
+        ]
+
+    if len(todo) > 0:
+        with Pool(processes) as pool:
+            pool.map(render_country_charts, todo)
+
+    for alpha3, d in todo:
+        manifest[alpha3] = d['version']
+    with open('charts.json', 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    print('rendered charts for {} countries, {} unchanged'.format(
+        len(todo), len(payloads) - len(todo)))
+
     return
 
 
+def render_country_charts(args):
+
+    # Write chart-XXX-<series>.svg for each graph of a country payload.
+    # Runs in a worker process, hence the single argument.
+
+    alpha3, d = args
+
+    for series, graph in d['graphs'].items():
+        if len(graph['history']) == 0:
+            continue
+        history = np.array([_[series] for _ in graph['history']], dtype=float)
+        forecast = np.array([_[series] for _ in graph['forecast']], dtype=float)
+        if series + 'Lower' in graph['forecast'][0]:
+            lower = np.array([_[series + 'Lower'] for _ in graph['forecast']], dtype=float)
+            upper = np.array([_[series + 'Upper'] for _ in graph['forecast']], dtype=float)
+        else:
+            lower = upper = None
+        with open('chart-{}-{}.svg'.format(alpha3, series), 'w') as f:
+            f.write(sparkline(history, forecast, lower, upper))
+
+    return
+
+
+def sparkline(history, forecast, lower=None, upper=None, width=300, height=80, color='#1890ff'):
+
+    # Minimal SVG line chart of the history followed by the dashed forecast and its band.
+    # The first forecast value is the latest history value.
+
+    x = np.arange(len(history) + len(forecast) - 1, dtype=float)
+    xForecast = x[len(history) - 1:]
+
+    arrays = [history, forecast]
+    if lower is not None:
+        arrays += [lower, upper]
+    yMin = min(_.min() for _ in arrays)
+    yMax = max(_.max() for _ in arrays)
+
+    def points(xs, ys):
+        px = 1 + (width - 2) * xs / max(x[-1], 1)
+        if yMax > yMin:
+            py = height - 1 - (height - 2) * (ys - yMin) / (yMax - yMin)
+        else:
+            py = np.full(len(ys), height / 2)
+        return ' '.join('{:.1f},{:.1f}'.format(*_) for _ in zip(px, py))
+
+    svg = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" viewBox="0 0 {0} {1}">'.format(
+            width, height),
+        ]
+    if lower is not None:
+        svg.append('<polygon points="{}" fill="{}" fill-opacity="0.15" stroke="none"/>'.format(
+            points(np.concatenate((xForecast, xForecast[::-1])), np.concatenate((upper, lower[::-1]))),
+            color))
+    svg.append('<polyline points="{}" fill="none" stroke="{}" stroke-width="1.5"/>'.format(
+        points(x[:len(history)], history), color))
+    svg.append('<polyline points="{}" fill="none" stroke="{}" stroke-width="1.5" stroke-dasharray="4 2"/>'.format(
+        points(xForecast, forecast), color))
+    svg.append('</svg>')
+
+    return '\n'.join(svg)
+
+
 def limitations_translation(column, value):
 
     # placeholder: https://github.com/iERP-ai/businesswithcovid-generator/issues/1#issue-597577465
@@ -616,6 +1251,108 @@ def prepare_country_dict(df_stringency):
     return d_name2alpha
 
 
+def validate_data(df_stringency, df_confirmed, df_deaths, df_recovered, d_name2alpha):
+
+    # Check all input data in one pass before any processing.
+    # Bad rows are quarantined (dropped) rather than stopping the run halfway through,
+    # and every issue found is written to validation-report.json.
+
+    issues = []
+
+    def report(check, df, CountryCode, Date, column, value):
+        issues.append(pd.DataFrame({
+            'check': check,
+            'CountryCode': CountryCode,
+            'Date': Date,
+            'column': column,
+            'value': value,
+            }, index=df.index))
+
+    # Allowed policy codes and flags in the order of the columns passed to
+    # the functions in calculate_iERPScoreB.
+    allowed = {
+        'S1': ((0, 1, 2), (0, 1)),
+        'S2': ((0, 1, 2), (0, 1)),
+        'S3': ((0, 1, 2), (0, 1)),
+        'S4': ((0, 1, 2), (0, 1)),
+        'S5': ((0, 1), (0, 1)),
+        'S6': ((0, 1, 2), (0, 1)),
+        'S7': ((0, 1, 2, 3),),
+        'S12': ((0, 1, 2, 3),),
+        'S13': ((0, 1, 2),),
+        }
+
+    df = df_stringency
+    quarantine = pd.Series(False, index=df.index)
+
+    for s, codes in allowed.items():
+        columns = [_ for _ in df.columns if all((
+            _.startswith(s + '_'),
+            not _.endswith('_Notes'),
+            ))]
+        for column, values in zip(columns, codes):
+            bad = ~df[column].isin(values)
+            report('policy code', df[bad], df['CountryCode'][bad], df['Date'][bad], column, df[column][bad])
+            quarantine |= bad
+
+    # Dates must be unique and increasing per country,
+    # i.e. later than every earlier date of the country, not just the previous one.
+    latestEarlier = df.groupby('CountryCode')['Date'].transform(lambda _: _.shift().cummax())
+    bad = df.duplicated(['CountryCode', 'Date']) | (df['Date'] <= latestEarlier.fillna(-1))
+    report('date order', df[bad], df['CountryCode'][bad], df['Date'][bad], 'Date', df['Date'][bad])
+    quarantine |= bad
+
+    # Cumulative counts should not decrease per country.
+    # Flag the values above any later value of the country, i.e. spikes or revised counts.
+    # Only report these, as the policy data and score of those days are still fine.
+    for column in ('ConfirmedCases', 'ConfirmedDeaths'):
+        df_reversed = df.iloc[::-1]
+        laterMin = df_reversed.groupby('CountryCode')[column].cummin().groupby(
+            df_reversed['CountryCode']).shift()
+        bad = df[column] > laterMin.reindex(df.index)
+        report('cumulative count', df[bad], df['CountryCode'][bad], df['Date'][bad], column, df[column][bad])
+
+    df_stringency = df_stringency[~quarantine].copy()
+    nQuarantined = int(quarantine.sum())
+
+    # Johns Hopkins country names must map to a country code.
+    # Skip cruise line ships.
+    names = df_confirmed['Country/Region']
+    unmapped = ~names.isin(d_name2alpha.keys()) & ~names.isin(('Diamond Princess', 'MS Zaandam'))
+    report('unmapped name', df_confirmed[unmapped], None, None, 'Country/Region', names[unmapped])
+    frames = []
+    for df in (df_confirmed, df_deaths, df_recovered):
+        bad = df['Country/Region'].isin(names[unmapped])
+        nQuarantined += int(bad.sum())
+        frames.append(df[~bad].copy())
+    df_confirmed, df_deaths, df_recovered = frames
+
+    # Johns Hopkins cumulative counts should not decrease either,
+    # but only report these, as dropping a province would distort the country totals.
+    for key, df in (('confirmed', df_confirmed), ('deaths', df_deaths), ('recovered', df_recovered)):
+        values = df.drop(['Province/State', 'Country/Region', 'Lat', 'Long'], axis=1)
+        rows, columns = np.nonzero(np.diff(values.values, axis=1) < 0)
+        report(
+            'cumulative count',
+            df.iloc[rows],
+            df['Country/Region'].map(d_name2alpha).values[rows],
+            values.columns.values[columns + 1],
+            key,
+            values.values[rows, columns + 1],
+            )
+
+    df_issues = pd.concat(issues)
+    print('quarantined {} rows, {} issues found'.format(nQuarantined, len(df_issues)))
+
+    with open('validation-report.json', 'w') as f:
+        json.dump({
+            'quarantined': nQuarantined,
+            'issues': df_issues.to_dict('records'),
+            }, f, indent=4, default=str)
+
+    return df_stringency, df_confirmed, df_deaths, df_recovered
+
+
 def calculate_iERPScoreB(df):
 
     weights = {
@@ -671,11 +1408,8 @@ def factors2values2(series, col1, col2):
     elif int(series[col1]) == 0 and int(series[col2]) == 1:
         return 0
     else:
-        print(series)
-        print('func2')
-        print(series[col1])
-        print(series[col2])
-        exit()
+        raise ValueError('{}: unexpected values {} {}'.format(
+            series.name, series[col1], series[col2]))
 
 
 def factors2values3(series, col1, col2):
@@ -693,11 +1427,8 @@ def factors2values3(series, col1, col2):
     elif int(series[col1]) == 0 and int(series[col2]) == 1:
         return 0
     else:
-        print(series)
-        print('func3')
-        print(series[col1])
-        print(series[col2])
-        exit()
+        raise ValueError('{}: unexpected values {} {}'.format(
+            series.name, series[col1], series[col2]))
 
 
 def factors1values4(series, col1):
@@ -711,11 +1442,8 @@ def factors1values4(series, col1):
     elif int(series[col1]) == 0:
         return 0
     else:
-        print(series)
-        print('func4')
-        print(series[col1])
-        print(series[col2])
-        exit()
+        raise ValueError('{}: unexpected value {}'.format(
+            series.name, series[col1]))
 
 
 def func12(series, col1):
@@ -729,10 +1457,8 @@ def func12(series, col1):
     elif int(series[col1]) == 0:
         return 10
     else:
-        print('func12')
-        print(series[col1])
-        print(series[col2])
-        exit()
+        raise ValueError('{}: unexpected value {}'.format(
+            series.name, series[col1]))
 
 
 def func13(series, col1):
@@ -744,10 +1470,173 @@ def func13(series, col1):
     elif int(series[col1]) == 0:
         return 10
     else:
-        print('func13')
-        print(series[col1])
-        print(series[col2])
-        exit()
+        raise ValueError('{}: unexpected value {}'.format(
+            series.name, series[col1]))
+
+
+def open_store(path='history.sqlite'):
+
+    # Append-only store of the daily values and forecasts of every run.
+    # A day is only stored again by a run if its values changed or it was removed,
+    # and queries pick the latest version up to a given run.
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run INTEGER PRIMARY KEY,
+                created TEXT NOT NULL
+                )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                CountryCode TEXT NOT NULL,
+                Date INTEGER NOT NULL,
+                run INTEGER NOT NULL,
+                iERPScoreB REAL,
+                ConfirmedCases REAL,
+                ConfirmedDeaths REAL,
+                removed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (CountryCode, Date, run)
+                ) WITHOUT ROWID""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS forecasts (
+                CountryCode TEXT NOT NULL,
+                series TEXT NOT NULL,
+                run INTEGER NOT NULL,
+                Date INTEGER NOT NULL,
+                value REAL,
+                lower REAL,
+                upper REAL,
+                model TEXT,
+                PRIMARY KEY (CountryCode, series, run, Date)
+                ) WITHOUT ROWID""")
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS history_run ON history (run)""")
+
+    return conn
+
+
+def store_history(conn, run, df_stringency):
+
+    # Store the days that are new or changed since the previous runs in one transaction,
+    # and mark the days that are no longer in df_stringency (e.g. quarantined) as removed.
+
+    columns = ['CountryCode', 'Date', 'iERPScoreB', 'ConfirmedCases', 'ConfirmedDeaths']
+
+    df_old = pd.read_sql_query("""
+        SELECT h.CountryCode, h.Date, h.iERPScoreB, h.ConfirmedCases, h.ConfirmedDeaths
+        FROM history h
+        JOIN (
+            SELECT CountryCode, Date, MAX(run) AS run
+            FROM history
+            WHERE run < ?
+            GROUP BY CountryCode, Date
+            ) USING (CountryCode, Date, run)
+        WHERE NOT h.removed
+        """, conn, params=(run,))
+
+    df = df_stringency[columns].merge(
+        df_old, on=['CountryCode', 'Date'], how='left', suffixes=('', 'Old'))
+    changed = pd.Series(False, index=df.index)
+    for column in columns[2:]:
+        changed |= df[column] != df[column + 'Old']
+    df = df[changed]
+
+    df_removed = df_old.merge(
+        df_stringency[['CountryCode', 'Date']], on=['CountryCode', 'Date'], how='left', indicator=True)
+    df_removed = df_removed[df_removed['_merge'] == 'left_only']
+
+    with conn:
+        # Replace anything stored by an earlier run on the same day.
+        conn.execute('DELETE FROM history WHERE run = ?', (run,))
+        conn.execute(
+            'INSERT OR REPLACE INTO runs VALUES (?, ?)',
+            (run, datetime.now().isoformat()))
+        conn.executemany(
+            'INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, 0)',
+            zip(
+                df['CountryCode'].tolist(),
+                df['Date'].tolist(),
+                itertools.repeat(run),
+                df['iERPScoreB'].tolist(),
+                df['ConfirmedCases'].tolist(),
+                df['ConfirmedDeaths'].tolist(),
+                ),
+            )
+        conn.executemany(
+            'INSERT INTO history VALUES (?, ?, ?, NULL, NULL, NULL, 1)',
+            zip(
+                df_removed['CountryCode'].tolist(),
+                df_removed['Date'].tolist(),
+                itertools.repeat(run),
+                ),
+            )
+
+    print('stored {} new or changed days, {} removed days'.format(len(df), len(df_removed)))
+
+    return
+
+
+def store_forecasts(conn, run, payloads):
+
+    # Store the forecasts of all country payloads in one transaction.
+
+    rows = []
+    for alpha3, d in payloads.items():
+        for series, graph in d['graphs'].items():
+            model = graph.get('model', 'rules')
+            for point in graph['forecast']:
+                rows.append((
+                    alpha3,
+                    series,
+                    run,
+                    int(point['d'].replace('-', '')),
+                    point[series],
+                    point.get(series + 'Lower'),
+                    point.get(series + 'Upper'),
+                    model,
+                    ))
+
+    with conn:
+        conn.execute('DELETE FROM forecasts WHERE run = ?', (run,))
+        conn.executemany(
+            'INSERT INTO forecasts VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    return
+
+
+def query_history(conn, CountryCode, run):
+
+    # Latest version of every day of a country as of the given run, ordered by date,
+    # leaving out days that were removed by then.
+
+    return conn.execute("""
+        SELECT Date, iERPScoreB, ConfirmedCases, ConfirmedDeaths
+        FROM history h
+        WHERE CountryCode = ? AND run = (
+            SELECT MAX(run)
+            FROM history
+            WHERE CountryCode = h.CountryCode AND Date = h.Date AND run <= ?
+            ) AND NOT removed
+        ORDER BY Date
+        """, (CountryCode, run)).fetchall()
+
+
+def query_score(conn, CountryCode, Date, run):
+
+    # Score of a country on a date as computed by the given run,
+    # or None if the day was not known or removed by then.
+
+    row = conn.execute("""
+        SELECT iERPScoreB
+        FROM history
+        WHERE CountryCode = ? AND Date = ? AND run <= ?
+        ORDER BY run DESC
+        LIMIT 1
+        """, (CountryCode, Date, run)).fetchone()
+
+    return None if row is None else row[0]
 
 
 def tmp_download():